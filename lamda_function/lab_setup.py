@@ -1,17 +1,19 @@
-import json
+import functools
 import logging
 import os
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import boto3
-import traceback
 import cfnresponse
 import sqlalchemy as sa
-import sqlparse
+from botocore.client import Config
 from botocore.exceptions import ClientError
 
 
 DBHOST = os.getenv("DBHOST", "")
-DBPORT = int(os.getenv("DBPORT", ""))
+DBPORT = int(os.getenv("DBPORT") or "5432")
 DBNAME = os.getenv("DBDATABASE", "postgres")
 DBUSER = os.getenv("DBUSER", "")
 DBPASSWORD = os.getenv("DBPASSWORD", "")
@@ -26,14 +28,29 @@ REGION = os.getenv("REGION", "us-east-1")
 
 CREATE = "Create"
 DELETE = "Delete"
+MAX_WORKERS = 32
+GLUE_BATCH_SIZE = 100
+S3_BATCH_SIZE = 1000
+MAX_S3_REQUESTS = 48
+MAX_PENDING_S3_BATCHES = 64
+STS_EXPIRATION_MARGIN = timedelta(seconds=120)
 response_data = {}
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-sts_client = boto3.client("sts")
-glue_client = boto3.client("glue", region_name=REGION)
-s3_client = boto3.client("s3", region_name=REGION)
-iam_client = boto3.client('iam', region_name=REGION)
+client_config = Config(max_pool_connections=64,
+                       tcp_keepalive=True,
+                       retries={'mode': 'adaptive', 'max_attempts': 10})
+sts_client = boto3.client("sts", config=client_config)
+glue_client = boto3.client("glue", region_name=REGION, config=client_config)
+s3_client = boto3.client("s3", region_name=REGION, config=client_config)
+iam_client = boto3.client('iam', region_name=REGION, config=client_config)
+# Bounds in-flight delete_objects calls across all buckets being emptied,
+# leaving pool connections free for the list_object_versions paginators
+s3_request_slots = threading.BoundedSemaphore(MAX_S3_REQUESTS)
+# Bounds delete_objects batches that are listed but not yet deleted, so
+# listing a bucket cannot run ahead of deleting it
+s3_pending_batches = threading.BoundedSemaphore(MAX_PENDING_S3_BATCHES)
 
 glue_jobs = [f"{PROJECT}-api-users-extract-job",
              f"{PROJECT}-api-sessions-extract-job",
@@ -41,27 +58,96 @@ glue_jobs = [f"{PROJECT}-api-users-extract-job",
              f"{PROJECT}-json-transform-job",
              f"{PROJECT}-songs-transform-job"]
 
+# Data quality rulesets created by terraform/modules/data_quality
+glue_rulesets = ["songs_dq_ruleset",
+                 "sessions_dq_ruleset",
+                 "users_dq_ruleset"]
+
 s3_buckets = [f"{PROJECT}-{ACCOUNT_ID}-{REGION}-scripts",
              f"{PROJECT}-{ACCOUNT_ID}-{REGION}-data-lake",
              f"{PROJECT}-{ACCOUNT_ID}-{REGION}-dags",
              f"{PROJECT}-{ACCOUNT_ID}-{REGION}-dbt"]
 
+# Database engine, kept across warm invocations of the container
+_engine = None
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = sa.create_engine(
+            sa.engine.URL.create(
+                "postgresql+psycopg2",
+                username=DBUSER,
+                password=DBPASSWORD,
+                host=DBHOST,
+                port=DBPORT,
+                database=DBNAME
+            ),
+            pool_size=1,
+            max_overflow=0,
+            pool_recycle=300,
+            pool_pre_ping=False
+        )
+    return _engine
+
+
+# Assumed role credentials, kept across warm invocations of the container
+_STS_CACHE = {}
+
+
 def sts_assume_role(role_arn):
+    credentials = _STS_CACHE.get(role_arn)
+    if credentials and \
+            datetime.now(tz=timezone.utc) + STS_EXPIRATION_MARGIN < credentials['Expiration']:
+        return credentials
     session_creds = sts_client.assume_role(
         RoleArn=role_arn,
         RoleSessionName="CreatePostgresSession"
     )
+    _STS_CACHE[role_arn] = session_creds['Credentials']
     return session_creds['Credentials']
 
 
-def empty_bucket(bucket_name: str):
+def delete_objects(bucket_name: str, objects: list, s3):
+    try:
+        with s3_request_slots:
+            response = s3.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': objects, 'Quiet': True}
+                )
+        for error in response.get('Errors', []):
+            logger.warning("Couldn't delete object: %s/%s %s %s \n",
+                           bucket_name, error['Key'], error['Code'], error['Message'])
+    except Exception as e:
+        logger.warning("Error deleting objects from bucket:%s %s \n", bucket_name, e,
+                       exc_info=True)
+
+
+def empty_bucket(bucket_name: str, s3):
+    try:
+        paginator = s3.get_paginator('list_object_versions')
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for page in paginator.paginate(Bucket=bucket_name):
+                objects = [{'Key': version['Key'], 'VersionId': version['VersionId']}
+                           for version in page.get('Versions', []) + page.get('DeleteMarkers', [])]
+                for i in range(0, len(objects), S3_BATCH_SIZE):
+                    s3_pending_batches.acquire()
+                    future = executor.submit(delete_objects, bucket_name,
+                                             objects[i:i + S3_BATCH_SIZE], s3)
+                    future.add_done_callback(lambda _: s3_pending_batches.release())
+    except Exception as e:
+        logger.warning("Error emptying bucket:%s %s \n", bucket_name, e,
+                       exc_info=True)
+
+
+def delete_job(job_name: str):
     try:
-        s3_resource = boto3.resource('s3')
-        bucket = s3_resource.Bucket(bucket_name)
-        bucket.object_versions.delete()
+        glue_client.delete_job(JobName=job_name)
+        logger.info("Deleted Glue job: %s", job_name)
     except Exception as e:
-        traceback_error = traceback.format_exc()
-        logger.warning(f"Error emptying bucket:{bucket_name} {e} \n")
+        logger.info(
+            "Glue job: %s does not exist. Exception: %s", job_name, e)
 
 
 def delete_table(database_name: str, table_name: str):
@@ -70,11 +156,47 @@ def delete_table(database_name: str, table_name: str):
             DatabaseName=database_name,
             Name=table_name
             )
-        logger.info(f"Deleted table: {database_name}.{table_name}\n")
+        logger.info("Deleted table: %s.%s\n", database_name, table_name)
+    except Exception as e:
+        logger.warning("Error details: . %s \n", e,
+                       exc_info=True)
+        logger.info("Couldn't delete table: %s.%s\n", database_name, table_name)
+
+
+def list_tables(database_name: str):
+    try:
+        paginator = glue_client.get_paginator('get_tables')
+        table_names = [table['Name']
+                       for page in paginator.paginate(DatabaseName=database_name)
+                       for table in page['TableList']]
+    except Exception as e:
+        logger.warning("Couldn't list tables of database: %s %s \n", database_name, e)
+        table_names = []
+    return table_names
+
+
+def delete_tables(database_name: str, table_names: list):
+    try:
+        response = glue_client.batch_delete_table(
+            DatabaseName=database_name,
+            TablesToDelete=table_names
+            )
     except Exception as e:
-        traceback_error = traceback.format_exc()
-        logger.warning(f"Error details: . {traceback_error} {e} \n")
-        logger.info(f"Couldn't delete table: {database_name}.{table_name}\n")
+        logger.warning("Error details: . %s \n", e,
+                       exc_info=True)
+        logger.info("Couldn't batch delete tables from: %s\n", database_name)
+        return
+    errors = response.get('Errors', [])
+    for error in errors:
+        logger.warning("Couldn't batch delete table: %s.%s %s \n",
+                       database_name, error['TableName'], error['ErrorDetail'])
+    logger.info("Deleted %s tables from: %s\n",
+                len(table_names) - len(errors), database_name)
+    # Tables that are already gone don't need a retry
+    failed_tables = [error['TableName'] for error in errors
+                     if error['ErrorDetail'].get('ErrorCode') != 'EntityNotFoundException']
+    for table_name in failed_tables:
+        delete_table(database_name, table_name)
 
 
 def delete_database(database_name: str):
@@ -82,79 +204,90 @@ def delete_database(database_name: str):
         response_delete_database = glue_client.delete_database(
             Name=database_name
         )
-        logger.info(f"Deleted database: {database_name}\n")
+        logger.info("Deleted database: %s\n", database_name)
     except Exception as e:
-        traceback_error = traceback.format_exc()
-        logger.warning(f"Error details: . {traceback_error} {e} \n")
-        logger.info(f"Couldn't delete database: {database_name}\n")
+        logger.warning("Error details: . %s \n", e,
+                       exc_info=True)
+        logger.info("Couldn't delete database: %s\n", database_name)
 
 
-def terraform_cleanup():
-    # Delete Glue DQ rulesets
+def delete_ruleset(ruleset_name: str):
     try:
-        glue_rulesets = glue_client.list_data_quality_rulesets()
-        glue_rulesets_list = glue_rulesets['Rulesets']
-        for glue_ruleset in glue_rulesets_list:
-            glue_ruleset_name = glue_ruleset['Name']
-            response = glue_rulesets.delete_data_quality_ruleset(
-                Name=glue_ruleset_name
-            )
+        glue_client.delete_data_quality_ruleset(Name=ruleset_name)
+        logger.info("Deleted Glue ruleset: %s", ruleset_name)
     except Exception as e:
-        logger.info(f"Failed to delete glue rulesets. Exception: {e}")
-    # Delete Glue jobs and databases
-    for job_name in glue_jobs:
-        try:
-            glue_client.delete_job(JobName=job_name)
-            logger.info(f"Deleted Glue job: {job_name}")
-        except Exception as e:
-            logger.info(
-                f"Glue job: {job_name} does not exist. Exception: {e}")
+        logger.info(
+            "Glue ruleset: %s does not exist. Exception: %s", ruleset_name, e)
+
+
+def empty_and_delete_database(database_name: str):
+    table_names = list_tables(database_name)
+    for i in range(0, len(table_names), GLUE_BATCH_SIZE):
+        delete_tables(database_name, table_names[i:i + GLUE_BATCH_SIZE])
+    delete_database(database_name)
+
+
+def delete_databases():
     try:
-        glue_databases = glue_client.get_databases()
-        glue_database_list = glue_databases['DatabaseList']
-        for glue_database in glue_database_list:
-            glue_database_name = glue_database['Name']
-            if 'default' == glue_database_name:
-                continue
-            glue_tables = glue_client.get_tables(DatabaseName=glue_database_name)
-            glue_table_list = glue_tables['TableList']
-            for table in glue_table_list:
-                glue_table_name = table['Name']
-                delete_table(glue_database_name, glue_table_name)
-            delete_database(glue_database_name)
+        glue_database_pages = glue_client.get_paginator('get_databases').paginate()
+        glue_database_names = [glue_database['Name']
+                               for page in glue_database_pages
+                               for glue_database in page['DatabaseList']
+                               if 'default' != glue_database['Name']]
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            wait([executor.submit(empty_and_delete_database, glue_database_name)
+                  for glue_database_name in glue_database_names])
     except Exception as e:
         logger.info(
-            f"Failed to delete glue databases. Exception: {e}")
-    # Delete Glue connection
+            "Failed to delete glue databases. Exception: %s", e)
+
+
+def delete_connection(connection_name: str):
     try:
-        connection_name = f'{PROJECT}-connection-rds'
         glue_client.delete_connection(ConnectionName=connection_name)
-        logger.info(f"Deleted Glue connection: {connection_name}")
+        logger.info("Deleted Glue connection: %s", connection_name)
     except Exception as e:
         logger.info(
-            f"Glue connection: {connection_name} does not exist. Exception: {e}")
-    # Delete IAM Role and Policy
-    iam_role = f"{PROJECT}-glue-role"
-    iam_policy = f"{PROJECT}-glue-role-policy"
+            "Glue connection: %s does not exist. Exception: %s", connection_name, e)
+
+
+def delete_role(iam_role: str, iam_policy: str):
     try:
         # Delete policies
         try:
             iam_client.delete_role_policy(RoleName=iam_role,
                                           PolicyName=iam_policy)
             logger.info(
-                f"Deleted policy: {iam_policy} from role: {iam_role}")
+                "Deleted policy: %s from role: %s", iam_policy, iam_role)
         except Exception as e:
             logger.info(
-                f"Cannot delete policy {iam_policy} from {iam_role}. Exception: {e}")
+                "Cannot delete policy %s from %s. Exception: %s", iam_policy, iam_role, e)
         # Delete role
         try:
             iam_client.delete_role(RoleName=iam_role)
-            logger.info(f"Deleted IAM role: {iam_role}")
+            logger.info("Deleted IAM role: %s", iam_role)
         except Exception as e:
             logger.info(
-                f"IAM role {iam_role} not found. Exception: {e}")
+                "IAM role %s not found. Exception: %s", iam_role, e)
     except ClientError as e:
-        logger.info(f"IAM role or policy do not exist. Exception: {e}")
+        logger.info("IAM role or policy do not exist. Exception: %s", e)
+
+
+def terraform_cleanup():
+    # Rulesets reference tables of the Glue databases, and jobs reference the
+    # connection and the IAM role, so those go first. Steps within each phase
+    # are independent of each other and run concurrently
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(delete_job, job_name) for job_name in glue_jobs]
+        futures.extend(executor.submit(delete_ruleset, ruleset_name)
+                       for ruleset_name in glue_rulesets)
+        wait(futures)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        wait([executor.submit(delete_databases),
+              executor.submit(delete_connection, f'{PROJECT}-connection-rds'),
+              executor.submit(delete_role,
+                              f"{PROJECT}-glue-role",
+                              f"{PROJECT}-glue-role-policy")])
 
 
 format_load = """SELECT aws_s3.table_import_from_s3(
@@ -165,28 +298,21 @@ format_load = """SELECT aws_s3.table_import_from_s3(
 
 
 def lambda_handler(event, context):
-    logger.warning(f"Event: {event}")
+    logger.warning("Event: %s", event)
     try:
         if event["RequestType"] == CREATE:
             terraform_cleanup()
-            logger.info(f"SQLAlchemy version {sa.__version__}")
+            logger.info("SQLAlchemy version %s", sa.__version__)
             # Reading file from S3
-            s3 = boto3.client("s3")
-
-            response = s3.get_object(Bucket=BUCKET_NAME, Key=OBJECT_KEY)
-            logger.info(f"response:  {response}")
+            response = s3_client.get_object(Bucket=BUCKET_NAME, Key=OBJECT_KEY)
+            logger.info("response: ContentLength=%s ETag=%s",
+                        response["ContentLength"], response["ETag"])
             sql_statement = response["Body"].read().decode("utf-8")
-            sql_list = sqlparse.split(sql_statement)
 
             # Population of Database
-            engine = sa.create_engine(
-                f"postgresql+psycopg2://{DBUSER}:{DBPASSWORD}@{DBHOST}/{DBNAME}"
-            )
-            with engine.connect() as conn:
-                for statement in sql_list:
-                    db_response = conn.execute(
-                        sa.text(statement).execution_options(autocommit=True)
-                    )
+            with get_engine().begin() as conn:
+                # Send the whole script in a single round trip
+                conn.execution_options(no_parameters=True).exec_driver_sql(sql_statement)
                 session_token = sts_assume_role(IAM_ROLE_ARN)
                 statement = format_load.format(
                     bucket_name=BUCKET_NAME,
@@ -195,34 +321,14 @@ def lambda_handler(event, context):
                     secret_key=session_token['SecretAccessKey'],
                     session_token=session_token['SessionToken']
                 )
-                db_response = conn.execute(
-                    sa.text(statement).execution_options(autocommit=True)
-                )
+                db_response = conn.execute(sa.text(statement))
 
         if event["RequestType"] == DELETE:
             # Delete elements in s3 buckets
-            for s3_bucket in s3_buckets:
-                empty_bucket(s3_bucket)
-            curl_data = {
-                "Status": "SUCCESS",
-                "PhysicalResourceId": event["PhysicalResourceId"],
-                "StackId": event["StackId"],
-                "RequestId": event["RequestId"],
-                "LogicalResourceId": event["LogicalResourceId"],
-            }
-
-            curl_command = [
-                "curl",
-                "-H",
-                "Content-Type: application/json",
-                "-X",
-                "PUT",
-                "-d",
-                json.dumps(curl_data),
-                event["ResponseURL"],
-            ]
-            logger.info(f"curl_command: {curl_command}")
+            with ThreadPoolExecutor(max_workers=len(s3_buckets)) as executor:
+                list(executor.map(functools.partial(empty_bucket, s3=s3_client),
+                                  s3_buckets))
         cfnresponse.send(event, context, cfnresponse.SUCCESS, response_data)
     except Exception as exc:
-        logger.error(f"Error: {str(exc)}")
+        logger.error("Error: %s", exc)
         cfnresponse.send(event, context, cfnresponse.FAILED, response_data)